@@ -30,6 +30,10 @@ Usage:
     The provided options let you fine tune running specific packages. For
     example, if you need to upgrade a dependency or build again.
     To force a dependency to rebuild, use --force.
+    Downloaded archives are cached in ~/.cache/google-api-cpp-deps and
+    reused even with --force. Remove that directory to download them again.
+    If ccache (or sccache) is on the PATH, compiles go through it so that
+    rebuilding with --force reuses the previously compiled objects.
 
     [-b] Just build the dependent packages in the --download_dir
     [-d] Just download the dependent packages to the --download_dir
@@ -39,28 +43,63 @@ Usage:
                             The default path is ./external_dependencies.
     [--install_dir=<path>] Specifies the install_dir.
                             The default path is ./external_dependencies/install.
+    [--update_manifest] Record the sha256 and size of the downloaded archives
+                        in deps_manifest.json.
     [cmake|curl|gflags|glog|gmock]* Process just the specific subset.
 
 
     If you wish to obtain and build a newer (or older) version of
     a dependency, simply change the url in this file and run this
     script again on that name with the --force flag.
+
+    deps_manifest.json can pin the sha256 and size of the archive for each
+    url. It ships without any pins, so archives are not checked until it is
+    populated by running from a trusted network with
+      --force -d --update_manifest
+    Once pinned, a mismatching archive is downloaded again and a mismatching
+    download is rejected.
 """
+from __future__ import print_function
+
+import collections
+import errno
+import functools
 import getopt
-import glob
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import platform
+import re
 import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
+import time
 import urllib
 import zipfile
 
+try:
+  from shutil import which  # Python 3.3+
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+try:
+  import urllib3
+except ImportError:
+  urllib3 = None  # Downloads fall back to urllib, one connection per file.
+
+UNPACKED_MARKER = '_unpacked'
 COMPILED_MARKER = '_built'
 INSTALLED_MARKER = '_installed'
 CONFIGURED_MARKER = '_configured'
 
+# Environment variables that change how a package is configured.
+CONFIGURE_ENVIRONMENT = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS',
+                         'LDFLAGS']
+
 CYGWIN_PLATFORM = 'cygwin'
 WINDOWS_PLATFORM = 'windows'
 OSX_PLATFORM = 'osx'
@@ -73,6 +112,28 @@ AUTO_CONFIG = 'auto'
 CONFIGURE_CONFIG = 'configure'
 CMAKE_CONFIG = 'cmake'
 
+# Number of packages downloaded or unpacked at the same time.
+DOWNLOAD_THREADS = 8
+
+# Size of the blocks that downloads are streamed to disk in.
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# Archives at least this large are downloaded in DOWNLOAD_CONNECTIONS
+# ranges at the same time when the server supports it.
+PARALLEL_DOWNLOAD_MIN_SIZE = 1 << 20
+DOWNLOAD_CONNECTIONS = 4
+
+# Minimum number of seconds between download progress updates.
+DOWNLOAD_PROGRESS_INTERVAL = 0.25
+
+# Seconds to wait for parallel tasks. Python 2 only lets Ctrl-C interrupt
+# waits that have a timeout, so this is just longer than any task takes.
+PARALLEL_WAIT_TIMEOUT = 7 * 24 * 60 * 60
+
+# Maps archive urls to their pinned {"sha256": ..., "size": ...}.
+DEPS_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'deps_manifest.json')
+
 
 class ConfigInfo(object):
   """Configuration information for how to build the dependencies."""
@@ -84,16 +145,21 @@ class ConfigInfo(object):
       abs_root_dir: (sring) The path tot he build root directory.
       unused_argv: (string) The program arguments, including argv[0].
     """
-    self._abs_root_dir = '%s' % abs_root_dir
+    self._abs_root_dir = abs_root_dir
     self._download_packages = False
     self._build_packages = False
     self._install_packages = False
     self._force = False
     self._debug = False
     self._download_dir = os.path.join(abs_root_dir, 'external_dependencies')
-    self._abs_install_dir = '%s' % os.path.join(
-        os.getcwd(), os.path.join('external_dependencies', 'install'))
-
+    self._download_cache_dir = os.path.expanduser(
+        os.path.join('~', '.cache', 'google-api-cpp-deps'))
+    self._abs_install_dir = os.path.join(
+        os.getcwd(), 'external_dependencies', 'install')
+    self._update_manifest = False
+    self._manifest = _LoadManifest(DEPS_MANIFEST_PATH)
+
+    self._use_ninja = which('ninja') is not None
     self._compiler = GCC_COMPILER
     if os.name == 'nt':
       self._port_name = WINDOWS_PLATFORM
@@ -105,9 +171,17 @@ class ConfigInfo(object):
     elif platform.system() == 'Linux':
       self._port_name = LINUX_PLATFORM
     else:
-      print 'Unknown system = %s. Assuming it is Linux compatible.' % (
-          platform.system())
+      print('Unknown system = %s. Assuming it is Linux compatible.' % (
+          platform.system()))
       self._port_name = LINUX_PLATFORM
+
+    self._compiler_launcher = None
+    if self._compiler != VS_COMPILER:
+      for launcher in ['ccache', 'sccache']:
+        if which(launcher):
+          self._compiler_launcher = launcher
+          break
+    self._ComputeBuildCommands()
     return
 
   def SetOptions(self, options):
@@ -130,14 +204,16 @@ class ConfigInfo(object):
       elif opt == '--force':
         self._force = True
       elif opt == '--download_dir':
-        self._download_dir = arg
+        self._download_dir = os.path.abspath(arg)
       elif opt == '--install_dir':
         if arg.startswith('/'):
-          self._abs_install_dir = '%s' % arg
+          self._abs_install_dir = arg
         else:
-          self._abs_install_dir = os.path.join('%s' % os.getcwd(), arg)
+          self._abs_install_dir = os.path.join(os.getcwd(), arg)
       elif opt == '--debug':
         self._debug = True
+      elif opt == '--update_manifest':
+        self._update_manifest = True
 
     if do_all:
       self._build_packages = True
@@ -145,23 +221,63 @@ class ConfigInfo(object):
       self._install_packages = True
 
     if self._build_packages:
-      print '   Build packages = True'
+      print('   Build packages = True')
     if self._download_packages:
-      print '   Download packages = True'
+      print('   Download packages = True')
     if self._install_packages:
-      print '   Installing packages = True'
+      print('   Installing packages = True')
 
     if self._download_packages:
-      print '   Downloading files to %s' % self._download_dir
-    if not os.path.exists(self._download_dir):
-      os.makedirs(self._download_dir)
+      print('   Downloading files to %s' % self._download_dir)
+    _EnsureDirectory(self._download_dir)
+    if self._download_packages:
+      _EnsureDirectory(self._download_cache_dir)
 
     if self._install_packages:
-      print '   Installing packages to %s' % self._abs_install_dir
-    if not os.path.exists(os.path.join(self._abs_install_dir, 'lib')):
-      os.makedirs(os.path.join(self._abs_install_dir, 'lib'))
-    if not os.path.exists(os.path.join(self._abs_install_dir, 'include')):
-      os.makedirs(os.path.join(self._abs_install_dir, 'include'))
+      print('   Installing packages to %s' % self._abs_install_dir)
+    _EnsureDirectory(os.path.join(self._abs_install_dir, 'lib'))
+    _EnsureDirectory(os.path.join(self._abs_install_dir, 'include'))
+    self._ComputeBuildCommands()
+
+  def _ComputeBuildCommands(self):
+    """Computes the build commands from the platform and current options.
+
+    The commands are read for every package, possibly from several threads,
+    so they are worked out once here whenever the options change.
+    """
+    try:
+      self._build_jobs = max(1, int(os.environ['CMAKE_BUILD_PARALLEL_LEVEL']))
+    except (KeyError, ValueError):
+      self._build_jobs = _CpuCount()
+
+    if os.name == 'nt':
+      # nmake cannot run jobs in parallel.
+      self._make_command = ('nmake', ['/C'], [])
+    else:
+      self._make_command = ('make', [], ['-j%d' % self._build_jobs])
+
+    if self._port_name == WINDOWS_PLATFORM:
+      program = 'cmake'
+      args = ['-G', 'NMake Makefiles']
+    elif self._port_name == CYGWIN_PLATFORM:
+      program = 'cmake'
+      args = ['-G', 'Unix Makefiles']
+    else:
+      program = os.path.join(self._abs_install_dir, 'bin', 'cmake')
+      args = []
+    if self._use_ninja:
+      args = ['-G', 'Ninja']
+    if self._debug:
+      args.append('-DCMAKE_BUILD_TYPE=Debug')
+    self._cmake_command = (program, args)
+
+    # The native arguments are passed through "cmake --build" to the build
+    # tool since the CMake we install is too old to have a --parallel option.
+    if self._use_ninja or os.name != 'nt':
+      native_args = ['-j%d' % self._build_jobs]
+    else:
+      native_args = []  # nmake cannot run jobs in parallel.
+    self._cmake_build_command = (program, native_args)
 
   @property
   def build_packages(self):
@@ -189,32 +305,32 @@ class ConfigInfo(object):
     return self._port_name
 
   @property
-  def make_command(self):
-    """A tuple of (make_program_path, make_argument_list) for using Make."""
-    if os.name == 'nt':
-      program = 'nmake'
-      args = '/C'
-    else:
-      program = 'make'
-      args = ''
+  def build_jobs(self):
+    """The number of jobs to run in parallel when building a package.
 
-    return (program, args)
+    This honors CMAKE_BUILD_PARALLEL_LEVEL if it is set in the environment.
+    """
+    return self._build_jobs
+
+  @property
+  def make_command(self):
+    """A tuple of (make_program_path, make_argument_list, parallel_args)."""
+    return self._make_command
 
   @property
   def cmake_command(self):
     """A tuple of (cmake_program_path, cmake_argument_list) for using CMake."""
-    if self._port_name == WINDOWS_PLATFORM:
-      program = 'cmake'
-      args = '-G "NMake Makefiles"'
-    elif self._port_name == CYGWIN_PLATFORM:
-      program = 'cmake'
-      args = '-G "Unix Makefiles"'
-    else:
-      program = os.path.join(self._abs_install_dir, 'bin', 'cmake')
-      args = ''
-    if self._debug:
-      args += ' -DCMAKE_BUILD_TYPE=Debug'
-    return (program, args)
+    return self._cmake_command
+
+  @property
+  def cmake_build_command(self):
+    """A tuple of (cmake_program_path, native_argument_list) for building."""
+    return self._cmake_build_command
+
+  @property
+  def compiler_launcher(self):
+    """The program compiles are run through, such as ccache, or None."""
+    return self._compiler_launcher
 
   @property
   def force(self):
@@ -226,6 +342,21 @@ class ConfigInfo(object):
     """The directory that we'll download and build external packages in."""
     return self._download_dir
 
+  @property
+  def manifest(self):
+    """Maps archive urls to their pinned sha256 and size."""
+    return self._manifest
+
+  @property
+  def update_manifest(self):
+    """Returns whether to record downloaded archives in the manifest."""
+    return self._update_manifest
+
+  @property
+  def download_cache_dir(self):
+    """The directory that downloaded archives are cached in across runs."""
+    return self._download_cache_dir
+
   @property
   def abs_install_dir(self):
     """The root directory for the external dependency installation dir."""
@@ -237,15 +368,213 @@ class ConfigInfo(object):
     return self._abs_root_dir
 
 
-def _DownloadStatusHook(a, b, c):
-  """Shows progress of download."""
-  print '% 3.1f%% of %d bytes\r' % (min(100, float(a * b) / c * 100), c)
+class _DownloadStatusHook(object):
+  """Shows progress of a download at most every DOWNLOAD_PROGRESS_INTERVAL.
+
+  Each download needs its own instance since it remembers when it last
+  printed.
+  """
+
+  def __init__(self):
+    self._last_time = 0
+
+  def __call__(self, a, b, c):
+    now = time.time()
+    # The total size c is -1 (or 0) when the server does not report it.
+    done = c > 0 and a * b >= c
+    if now - self._last_time < DOWNLOAD_PROGRESS_INTERVAL and not done:
+      return
+    self._last_time = now
+    if c > 0:
+      print('% 3.1f%% of %d bytes\r' % (min(100, float(a * b) / c * 100), c))
+    else:
+      print('%d bytes\r' % (a * b))
+
+
+# The directories _EnsureDirectory has already made sure exist.
+_ENSURED_DIRECTORIES = set()
+
+
+def _EnsureDirectory(path):
+  """Creates the directory and any missing parents if it does not exist.
+
+  Directories are remembered once they exist, so asking again for the same
+  directory (such as the install lib dir for every package) is free.
+
+  Args:
+    path: (string) The directory to create.
+  """
+  if path in _ENSURED_DIRECTORIES:
+    return
+  try:
+    os.makedirs(path)
+  except OSError as e:
+    # Tolerate another thread having created it first.
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+  _ENSURED_DIRECTORIES.add(path)
+
+
+def _DownloadAll(installers):
+  """Downloads the packages concurrently, sharing one connection pool.
+
+  Args:
+    installers: (list[PackageInstaller]) The packages to download.
+  """
+  _RunInParallel([installer.Download for installer in installers],
+                 DOWNLOAD_THREADS)
+
+
+def _LoadManifest(path):
+  """Returns the dependency manifest, or an empty one if there is none.
+
+  Args:
+    path: (string) The path of the manifest file.
+  """
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except IOError:
+    return {}
+
+
+def _SaveManifest(path, manifest):
+  """Writes the dependency manifest.
+
+  Args:
+    path: (string) The path of the manifest file.
+    manifest: (dict) Maps archive urls to their pinned sha256 and size.
+  """
+  with open(path, 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True, separators=(',', ': '))
+    f.write('\n')
+
+
+def _FileDigest(path):
+  """Returns the sha256 hexdigest of a file, reading it in blocks.
+
+  Args:
+    path: (string) The path of the file to digest.
+  """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(functools.partial(f.read, DOWNLOAD_BLOCK_SIZE), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _SubstituteInFile(path, pattern, replacement):
+  """Replaces every match of a pattern in a file, in a single pass.
+
+  Args:
+    path: (string) The file to edit.
+    pattern: (RegexObject) The compiled pattern to replace.
+    replacement: (string) What to replace each match with.
+
+  Returns:
+    Whether the file was changed. It is not rewritten if nothing matched.
+  """
+  with open(path, 'r') as f:
+    text, count = pattern.subn(replacement, f.read())
+  if count:
+    with open(path, 'w') as f:
+      f.write(text)
+  return count > 0
+
+
+def _ReadMarker(path):
+  """Returns the digest recorded in a marker file, or None if there is none.
+
+  Args:
+    path: (string) The path of the marker file.
+  """
+  try:
+    with open(path, 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+
+def _WriteMarker(path, payload):
+  """Writes a marker file recording the digest of the inputs to a step.
+
+  Args:
+    path: (string) The path of the marker file.
+    payload: (string) Describes everything the step's outcome depends on.
+  """
+  with open(path, 'w') as f:
+    f.write(hashlib.sha256(payload).hexdigest())
+
+
+def _MarkerMatches(path, payload):
+  """Returns whether the marker file was written for the given payload.
+
+  Args:
+    path: (string) The path of the marker file.
+    payload: (string) Describes everything the step's outcome depends on.
+  """
+  return _ReadMarker(path) == hashlib.sha256(payload).hexdigest()
+
+
+def _CpuCount():
+  """Returns the number of CPUs on this machine, or 1 if it is not known."""
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+def _RunInParallel(tasks, max_workers):
+  """Runs the tasks concurrently and waits for them all to finish.
+
+  The tasks report failures by exiting, as RunOrDie does. Since that would
+  only terminate the worker thread, the exit is re-raised here once all the
+  tasks have finished.
+
+  Args:
+    tasks: (list[callable]) The functions to call, without arguments.
+    max_workers: (int) The most tasks to run at the same time.
+  """
+  def _RunTask(task):
+    try:
+      task()
+    except SystemExit as e:
+      return e.code or 1
+    return 0
+
+  if not tasks:
+    return
+  pool = ThreadPool(min(max_workers, len(tasks)))
+  result = pool.map_async(_RunTask, tasks)
+  pool.close()
+  try:
+    exit_codes = result.get(PARALLEL_WAIT_TIMEOUT)
+  except KeyboardInterrupt:
+    # The workers are daemon threads, so busy ones do not hold up the exit.
+    pool.terminate()
+    raise
+  pool.join()
+  for code in exit_codes:
+    if code:
+      sys.exit(code)
 
 
 class PackageInstaller(object):
   """Acquires, builds, and installs an individual package for use in the SDK.
   """
 
+  # Matches the archive suffixes that _ArchiveToPackage strips.
+  _ARCHIVE_SUFFIX_RE = re.compile(r'\.(?:tar\.gz|zip|tgz|tar\.bz2)$')
+
+  # Maps program names to whether _VerifyProgram found them on the PATH.
+  _verified_progs = {}
+
+  # Shared by all the downloads so connections to the same host are reused.
+  _http = urllib3 and urllib3.PoolManager(
+      num_pools=4, maxsize=DOWNLOAD_THREADS * DOWNLOAD_CONNECTIONS,
+      retries=urllib3.Retry(connect=3, read=3, redirect=10,
+                            backoff_factor=0.5))
+
   def __init__(self, config, url,
                make_target='all',
                package_name='',
@@ -279,6 +608,7 @@ class PackageInstaller(object):
     self._vc_project_path = ''
     self._vc_upgrade_from_project_path = ''
     self._msbuild_args = ''
+    self._archive_digest = None
 
   def UpgradeVisualStudio(self, from_project, to_project):
     """Upgrades visual studio project.
@@ -289,10 +619,10 @@ class PackageInstaller(object):
                            (conversion might be in-place).
     """
     if from_project == to_project or not os.path.exists(to_project):
-      print '>>> Upgrading %s' % from_project
-      upgrade_cmd = 'devenv "%s" /upgrade' % from_project
+      print('>>> Upgrading %s' % from_project)
       PackageInstaller.RunOrDie(
-          upgrade_cmd, 'Devenv failed to upgrade project.')
+          ['devenv', from_project, '/upgrade'],
+          'Devenv failed to upgrade project.')
 
   def Download(self):
     """Downloads URL to file in configured download_dir."""
@@ -302,14 +632,32 @@ class PackageInstaller(object):
     download_dir = config.download_dir
     download_path = os.path.join(download_dir, filename)
     if os.path.exists(download_path) and not config.force:
-      print '%s already exists - skipping download from %s' % (filename, url)
-      return
+      if self._AcceptArchive(download_path):
+        print('%s already exists - skipping download from %s' % (
+            filename, url))
+        return
+      print('%s does not match the manifest - downloading again' % filename)
+
+    cache_path = self._ContentAddressedPath(url)
+    if os.path.exists(cache_path):
+      if self._AcceptArchive(cache_path):
+        print('Using cached %s for %s' % (cache_path, filename))
+        PackageInstaller._LinkOrCopy(cache_path, download_path)
+        return
+      os.unlink(cache_path)
 
-    print 'Downloading %s from %s: ' % (filename, url)
+    print('Downloading %s from %s: ' % (filename, url))
+    fd, temp_path = tempfile.mkstemp(dir=config.download_cache_dir)
+    os.close(fd)
     try:
-      urllib.urlretrieve(url, download_path, _DownloadStatusHook)
+      if self._http:
+        if not self._ParallelDownload(url, temp_path):
+          self._FetchFromPool(url, temp_path)
+      else:
+        urllib.urlretrieve(url, temp_path, _DownloadStatusHook())
     except IOError:
-      print ('\nERROR:\n'
+      os.unlink(temp_path)
+      print('\nERROR:\n'
              'Could not download %s.\n' % url
              + ('It could be that this particular version is no longer'
                 ' available.\n'
@@ -321,6 +669,170 @@ class PackageInstaller(object):
                 '\n'))
       sys.exit(1)
 
+    if not self._AcceptArchive(temp_path):
+      os.unlink(temp_path)
+      print('\nERROR:\n'
+            'The archive downloaded from %s does not match %s.\n'
+            'Run again with --update_manifest if the new archive is trusted.'
+            % (url, DEPS_MANIFEST_PATH))
+      sys.exit(1)
+
+    os.rename(temp_path, cache_path)
+    PackageInstaller._LinkOrCopy(cache_path, download_path)
+
+  def _VerifyArchive(self, path):
+    """Returns whether an archive matches what the manifest pins for its url.
+
+    Urls missing from the manifest, or without a pinned sha256 or size,
+    are not checked for that value.
+
+    Args:
+      path: (string) The archive to check.
+    """
+    entry = self._config.manifest.get(self._url) or {}
+    size = entry.get('size')
+    if size is not None and os.path.getsize(path) != size:
+      return False
+    sha256 = entry.get('sha256')
+    return sha256 is None or _FileDigest(path) == sha256
+
+  def _AcceptArchive(self, path):
+    """Returns whether an archive can be used for this package's url.
+
+    With --update_manifest every archive is accepted and its sha256 and
+    size are recorded in the manifest. Otherwise it has to match the
+    manifest.
+
+    Args:
+      path: (string) The archive to check.
+    """
+    config = self._config
+    if not config.update_manifest:
+      return self._VerifyArchive(path)
+    config.manifest[self._url] = {'sha256': _FileDigest(path),
+                                  'size': os.path.getsize(path)}
+    return True
+
+  def _ArchiveDigest(self):
+    """Returns the sha256 of the downloaded archive, computing it once."""
+    if not self._archive_digest:
+      self._archive_digest = _FileDigest(
+          os.path.join(self._config.download_dir, self._archive_file))
+    return self._archive_digest
+
+  def _UnpackedMarkerPath(self):
+    """Returns the path of the marker recording what was unpacked."""
+    return os.path.join(self._config.download_dir,
+                        self._package_name + UNPACKED_MARKER)
+
+  def _ContentAddressedPath(self, url):
+    """Returns the path that the archive at url is cached at.
+
+    Release archive urls are immutable so the url identifies the content.
+
+    Args:
+      url: (string) The url the archive is downloaded from.
+    """
+    return os.path.join(self._config.download_cache_dir,
+                        hashlib.sha256(url).hexdigest())
+
+  def _FetchFromPool(self, url, download_path):
+    """Streams URL to download_path over the shared connection pool.
+
+    Args:
+      url: (string) The url to download.
+      download_path: (string) The file to write the download to.
+
+    Raises:
+      IOError: if the file could not be downloaded.
+    """
+    try:
+      response = self._http.request('GET', url, preload_content=False)
+      try:
+        if response.status != 200:
+          raise IOError('HTTP status %d' % response.status)
+        total = int(response.headers.get('Content-Length', -1))
+        received = 0
+        status_hook = _DownloadStatusHook()
+        with open(download_path, 'wb') as f:
+          # The archive is written as sent, even if it was sent gzip encoded.
+          for block in response.stream(DOWNLOAD_BLOCK_SIZE,
+                                       decode_content=False):
+            f.write(block)
+            received += len(block)
+            status_hook(received, 1, total)
+        # urllib3 does not check that the whole body arrived.
+        if total > 0 and received != total:
+          raise IOError('Received %d of %d bytes' % (received, total))
+      finally:
+        response.release_conn()
+    except urllib3.exceptions.HTTPError as e:
+      raise IOError(str(e))
+
+  def _ParallelDownload(self, url, download_path, n=DOWNLOAD_CONNECTIONS):
+    """Downloads URL to download_path as n byte ranges at the same time.
+
+    Args:
+      url: (string) The url to download.
+      download_path: (string) The file to write the download to.
+      n: (int) The number of ranges to download at the same time.
+
+    Returns:
+      False if the server does not support ranges or the file is too small
+      to be worth splitting, in which case download_path is not complete.
+
+    Raises:
+      IOError: if the file could not be downloaded.
+    """
+    try:
+      head = self._http.request('HEAD', url)
+    except urllib3.exceptions.HTTPError:
+      return False
+    length = int(head.headers.get('Content-Length', 0))
+    if (head.status != 200 or length < PARALLEL_DOWNLOAD_MIN_SIZE
+        or head.headers.get('Accept-Ranges') != 'bytes'):
+      return False
+
+    with open(download_path, 'wb') as f:
+      f.truncate(length)
+
+    def _FetchRange(start, end):
+      headers = {'Range': 'bytes=%d-%d' % (start, end)}
+      try:
+        response = self._http.request('GET', url, headers=headers,
+                                      preload_content=False)
+        try:
+          if response.status == 200:
+            # The server ignored the range and is sending the whole file.
+            response.close()
+            return False
+          if response.status != 206:
+            raise IOError('HTTP status %d for range' % response.status)
+          with open(download_path, 'r+b') as f:
+            f.seek(start)
+            for block in response.stream(DOWNLOAD_BLOCK_SIZE,
+                                         decode_content=False):
+              f.write(block)
+            if f.tell() != end + 1:
+              raise IOError('Short read of range %d-%d' % (start, end))
+          return True
+        finally:
+          response.release_conn()
+      except urllib3.exceptions.HTTPError as e:
+        raise IOError(str(e))
+
+    print('Downloading %d bytes over %d connections' % (length, n))
+    part_size = (length + n - 1) // n
+    ranges = [(start, min(start + part_size, length) - 1)
+              for start in range(0, length, part_size)]
+    pool = ThreadPool(len(ranges))
+    try:
+      fetched = pool.map(lambda r: _FetchRange(*r), ranges)
+    finally:
+      pool.close()
+      pool.join()
+    return all(fetched)
+
   def MaybeTweakAfterUnpackage(self):
     """Extra stuff to do after unpackaging an archive."""
     config = self._config
@@ -343,53 +855,57 @@ class PackageInstaller(object):
     config = self._config
     download_dir = config.download_dir
     archive_filename = self._archive_file
+    archive_path = os.path.join(download_dir, archive_filename)
     package = self._package_name
-    os.chdir(download_dir)
+    package_path = os.path.join(download_dir, package)
 
-    if not os.path.exists(archive_filename):
-      print '%s does not exist in %s' % (
-          archive_filename, config.download_dir)
+    if not os.path.exists(archive_path):
+      print('%s does not exist in %s' % (
+          archive_filename, config.download_dir))
       sys.exit(1)
 
-    if os.path.exists(self._package_name):
-      if not config.force:
+    # The marker sits beside the package so that removing the package does
+    # not leave it behind. It records the content of the archive the package
+    # came from, so a replaced archive or an interrupted unpack is redone.
+    marker_path = self._UnpackedMarkerPath()
+    payload = '%s\n%s' % (archive_filename, self._ArchiveDigest())
+    if os.path.exists(package_path):
+      if not config.force and _MarkerMatches(marker_path, payload):
         self.MaybeTweakAfterUnpackage()
         return
-      print 'Removing existing %s' % self._package_name
-      shutil.rmtree(self._package_name)
+      print('Removing existing %s' % self._package_name)
+      shutil.rmtree(package_path)
+    if os.path.exists(marker_path):
+      os.unlink(marker_path)
 
-    print '\n>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-    print '>>>  Unpacking %s into %s' % (archive_filename, package)
+    print('\n>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+    print('>>>  Unpacking %s into %s' % (archive_filename, package))
+    pigz = which('pigz')
     if archive_filename.endswith('zip'):
-      z = zipfile.ZipFile(archive_filename)
-      for elem in z.namelist():
-        dirname, filename = os.path.split(elem)
-        if not os.path.exists(dirname):
-          os.makedirs(dirname)
-        if filename:
-          with open(elem, 'w') as f:
-            f.write(z.read(elem))
-      z.close()
+      with zipfile.ZipFile(archive_path) as z:
+        z.extractall(download_dir)
     elif archive_filename.endswith('.bz2'):
-      try:
-        subprocess.call('tar -xjf %s' % archive_filename, shell=True)
-      except OSError:
-        print 'Failed to unpack %s' % archive_filename
-        sys.exit(-1)
+      PackageInstaller.RunOrDie(
+          ['tar', '-xjf', archive_filename],
+          'Failed to unpack %s' % archive_filename, cwd=download_dir)
+    elif pigz and archive_filename.endswith(('.tar.gz', '.tgz')):
+      # pigz decompresses using all the cores.
+      PackageInstaller.RunOrDie(
+          ['tar', '--use-compress-program=%s' % pigz, '-xf', archive_filename],
+          'Failed to unpack %s' % archive_filename, cwd=download_dir)
     else:
       try:
-        tar = tarfile.open(archive_filename)
-        tar.extractall()
+        tar = tarfile.open(archive_path)
+        tar.extractall(download_dir)
         tar.close()
       except IOError:
-        try:
-          subprocess.call('tar -xf %s' % archive_filename, shell=True)
-        except OSError:
-          print 'Failed to unpack %s' % archive_filename
-          sys.exit(-1)
+        PackageInstaller.RunOrDie(
+            ['tar', '-xf', archive_filename],
+            'Failed to unpack %s' % archive_filename, cwd=download_dir)
 
+    _WriteMarker(marker_path, payload)
     self.MaybeTweakAfterUnpackage()
-    print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
 
   def DetermineConfigType(self, path):
     """Detemines how to configure the directory depending on files.
@@ -407,136 +923,217 @@ class PackageInstaller(object):
       return CONFIGURE_CONFIG
     if os.path.exists(os.path.join(path, 'Configure')):
       return CONFIGURE_CONFIG
-    print 'Could not determine how to configure %s' % path
+    print('Could not determine how to configure %s' % path)
     sys.exit(1)
 
+  def _ResolveConfigType(self):
+    """Returns how the package is configured, determining it if needed."""
+    if self._config_type == AUTO_CONFIG:
+      return self.DetermineConfigType(self._package_path)
+    return self._config_type
+
   def Configure(self):
     """Configure the package."""
 
     config = self._config
-    os.chdir(self._package_path)
-    marker_path = CONFIGURED_MARKER
-    if os.path.exists(marker_path):
-      if not config.force:
-        print '%s already configured' % self._package_name
-        return
-      # remove built since we are forcing a rebuild
-      os.unlink(marker_path)
-
-    config_type = self._config_type
-    if config_type == AUTO_CONFIG:
-      config_type = self.DetermineConfigType('.')
-
+    config_type = self._ResolveConfigType()
     if not config_type:
-      pass
+      cmd = None
     elif config_type == CMAKE_CONFIG:
-      configure_cmd = '%s %s' % (
-          config.cmake_command[0], config.cmake_command[1])
-      prefix_arg = '-DCMAKE_INSTALL_PREFIX:PATH="%s" .' % (
-          config.abs_install_dir)
+      cmd = ([config.cmake_command[0]] + config.cmake_command[1]
+             + ['-DCMAKE_INSTALL_PREFIX:PATH=%s' % config.abs_install_dir,
+                '.'])
     elif config_type == CONFIGURE_CONFIG:
       # Normally the automake uses a script called 'configure'
       # but for some reason openssl calls it 'Configure'.
       configure_cmd = os.path.join('.', 'configure')
-      if not os.path.exists(configure_cmd):
+      if not os.path.exists(os.path.join(self._package_path, configure_cmd)):
         configure_cmd = os.path.join('.', 'Configure')
 
-      prefix_arg = '--prefix="%s" %s' % (
-          config.abs_install_dir, self._extra_configure_flags)
+      cmd = ([configure_cmd, '--prefix=%s' % config.abs_install_dir]
+             + self._extra_configure_flags.split())
 
-    if not config_type:
-      cmd = None
-    elif config.port == WINDOWS_PLATFORM:
-      cmd = '%s %s' % (configure_cmd, prefix_arg)
-    else:
-      ldflags = '-L%s/lib %s' % (
+    env_overrides = {}
+    if cmd and config.port != WINDOWS_PLATFORM:
+      env_overrides['LDFLAGS'] = '-L%s/lib %s' % (
           config.abs_install_dir, self._extra_ldflags)
-      cppflags = '-I%s/include %s' % (
+      env_overrides['CPPFLAGS'] = '-I%s/include %s' % (
           config.abs_install_dir, self._extra_cppflags)
-      cmd = 'LDFLAGS="%s" CPPFLAGS="%s" %s %s' % (
-          ldflags, cppflags, configure_cmd, prefix_arg)
+    # The CMake we install predates CMAKE_<LANG>_COMPILER_LAUNCHER, but
+    # both it and configure run the launcher when it leads CC and CXX.
+    launcher = config.compiler_launcher
+    if config_type in (CONFIGURE_CONFIG, CMAKE_CONFIG) and launcher:
+      for name, default in [('CC', 'gcc'), ('CXX', 'g++')]:
+        compiler = os.environ.get(name, default)
+        if not compiler.startswith(launcher):
+          env_overrides[name] = '%s %s' % (launcher, compiler)
+
+    # Rerun whenever the sources, command, compiler or build environment
+    # changes.
+    marker_path = os.path.join(self._package_path, CONFIGURED_MARKER)
+    env = dict(os.environ, **env_overrides)
+    payload = '\n'.join(
+        [_ReadMarker(self._UnpackedMarkerPath()) or '',
+         ' '.join(cmd or []), self._extra_configure_flags, config.compiler]
+        + ['%s=%s' % (name, env.get(name, ''))
+           for name in CONFIGURE_ENVIRONMENT])
+    if _MarkerMatches(marker_path, payload):
+      if not config.force:
+        print('%s already configured' % self._package_name)
+        return
+    if os.path.exists(marker_path):
+      # remove configured since we are forcing a reconfigure
+      os.unlink(marker_path)
+    if config_type == CMAKE_CONFIG:
+      # CMake keeps using the cached build type, compilers and generator
+      # over the command line, so start from a clean cache.
+      cache_path = os.path.join(self._package_path, 'CMakeCache.txt')
+      if os.path.exists(cache_path):
+        os.unlink(cache_path)
+      shutil.rmtree(os.path.join(self._package_path, 'CMakeFiles'),
+                    ignore_errors=True)
 
     if cmd:
       PackageInstaller.RunOrDie(
-          cmd, 'Failed to configure %s' % self._package_name)
+          cmd, 'Failed to configure %s' % self._package_name,
+          cwd=self._package_path, env=env)
 
-    # touch file so we know we configured it.
-    open(marker_path, 'w').close()
+    # record what we configured with so we know if we need to again.
+    _WriteMarker(marker_path, payload)
 
-    print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-    print '>>>  Finished configuring %s' % self._package_name
-    print '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>\n'
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
+    print('>>>  Finished configuring %s' % self._package_name)
+    print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>\n')
 
   def Compile(self):
     """Compiles a package but does not install it."""
     package_name = self._package_name
     config = self._config
-    os.chdir(self._package_path)
-    marker_path = COMPILED_MARKER
-    if os.path.exists(marker_path):
+    make_dir = self._package_path
+    if self._vc_project_path and config.compiler == VS_COMPILER:
+      make_dir, filename = os.path.split(self._vc_project_path)
+      make_cmd = (['msbuild', filename] + self._msbuild_args.split()
+                  + ['/m:%d' % config.build_jobs])
+    elif self._ResolveConfigType() == CMAKE_CONFIG:
+      program, native_args = config.cmake_build_command
+      make_cmd = ([program, '--build', '.', '--target', self._make_target,
+                   '--'] + native_args)
+    else:
+      program, args, parallel_args = config.make_command
+      make_cmd = [program] + args + parallel_args + [self._make_target]
+
+    # Rebuild whenever the target changes or the package is reconfigured.
+    # The job count is left out since it does not change what gets built.
+    marker_path = os.path.join(self._package_path, COMPILED_MARKER)
+    payload = '\n'.join([self._make_target, self._msbuild_args, str(
+        _ReadMarker(os.path.join(self._package_path, CONFIGURED_MARKER)))])
+    if _MarkerMatches(marker_path, payload):
       if not config.force:
-        print '%s already built' % package_name
+        print('%s already built' % package_name)
         return
+    if os.path.exists(marker_path):
       # remove built since we are forcing a rebuild
       os.unlink(marker_path)
 
     PackageInstaller._VerifyMakeOrDie(config.make_command[0])
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
-    print '+++  Building %s [%s]' % (package_name, self._make_target)
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
-    if self._vc_project_path and config.compiler == VS_COMPILER:
-      dirname, filename = os.path.split(self._vc_project_path)
-      os.chdir(dirname)
-      make_cmd = 'msbuild "%s" %s' % (filename, self._msbuild_args)
-    else:
-      make_cmd = '%s %s %s' % (
-          config.make_command[0], config.make_command[1], self._make_target)
-    PackageInstaller.RunOrDie(make_cmd, 'Failed to make %s' % package_name)
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+    print('+++  Building %s [%s]' % (package_name, self._make_target))
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+    PackageInstaller.RunOrDie(make_cmd, 'Failed to make %s' % package_name,
+                              cwd=make_dir)
 
-    # touch file so we know we built it.
-    open(marker_path, 'w').close()
+    # record what we built with so we know if we need to again.
+    _WriteMarker(marker_path, payload)
 
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
-    print '+++  Finished building %s' % package_name
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n'
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+    print('+++  Finished building %s' % package_name)
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n')
 
   def Install(self):
     """Installs a pre-built package using a make-rule."""
     self.MakeInstall()
 
+  def _InstalledArtifacts(self):
+    """Returns the files that Install() puts into the install tree.
+
+    Returns:
+      list of paths relative to the install directory. An empty list means
+      the installed files are not known so the package is always installed.
+    """
+    return []
+
+  def _InstallUnlessPresent(self):
+    """Installs the package unless its artifacts are already installed.
+
+    This catches install trees that outlived the source tree holding the
+    INSTALLED_MARKER, such as when only external_dependencies/install is kept.
+    An existing marker always decides, so a stale one still reinstalls, and
+    a package built after the artifacts were installed, such as a new
+    version, is always installed over them.
+    """
+    config = self._config
+    marker_path = os.path.join(self._package_path, INSTALLED_MARKER)
+    compiled_path = os.path.join(self._package_path, COMPILED_MARKER)
+    artifact_paths = [os.path.join(config.abs_install_dir, path)
+                      for path in self._InstalledArtifacts()]
+    installed = (artifact_paths and not config.force
+                 and not os.path.exists(marker_path)
+                 and all(os.path.exists(path) for path in artifact_paths))
+    if installed and os.path.exists(compiled_path):
+      installed = (os.path.getmtime(compiled_path)
+                   < min(os.path.getmtime(path) for path in artifact_paths))
+    if installed:
+      print('%s already installed in %s' % (self._package_name,
+                                            config.abs_install_dir))
+      return
+    self.Install()
+
   def MakeInstall(self):
     """Installs a pre-built package, including ones we built ourself."""
     package_name = self._package_name
     config = self._config
-    os.chdir(self._package_path)
-    marker_path = INSTALLED_MARKER
-    if os.path.exists(marker_path):
+
+    # Reinstall whenever the install tree moves or the package is rebuilt.
+    marker_path = os.path.join(self._package_path, INSTALLED_MARKER)
+    payload = '%s\n%s' % (config.abs_install_dir, _ReadMarker(
+        os.path.join(self._package_path, COMPILED_MARKER)))
+    if _MarkerMatches(marker_path, payload):
       if not config.force:
-        print '%s already installed' % package_name
+        print('%s already installed' % package_name)
         return
-      # remove built since we are forcing an install
+    if os.path.exists(marker_path):
+      # remove installed since we are forcing an install
       os.unlink(marker_path)
 
     PackageInstaller._VerifyMakeOrDie(config.make_command[0])
 
-    print '\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
-    print '+++  Installing %s' % package_name
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
+    print('\n++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+    print('+++  Installing %s' % package_name)
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
 
-    cmd = '%s %s install' % config.make_command
-    PackageInstaller.RunOrDie(cmd, 'Failed to install %s' % package_name)
+    if self._ResolveConfigType() == CMAKE_CONFIG:
+      cmd = [config.cmake_command[0], '--build', '.', '--target', 'install']
+    else:
+      program, args, parallel_args = config.make_command
+      cmd = [program] + args + parallel_args + ['install']
+    PackageInstaller.RunOrDie(cmd, 'Failed to install %s' % package_name,
+                              cwd=self._package_path)
 
-    # touch file so we know we installed it.
-    open(marker_path, 'w').close()
+    # record what we installed so we know if we need to again.
+    _WriteMarker(marker_path, payload)
 
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
-    print '+++  Finished installing %s' % package_name
-    print '++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++'
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+    print('+++  Finished installing %s' % package_name)
+    print('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
 
-  def Process(self):
-    """Runs standard workflow to obatin and prepare dependencies."""
+  def Process(self, download=True):
+    """Runs standard workflow to obatin and prepare dependencies.
+
+    Args:
+      download: (bool) False if the package was already downloaded.
+    """
     config = self._config
-    if config.download_packages:
+    if config.download_packages and download:
       self.Download()
 
     if config.build_packages or config.install_packages:
@@ -549,46 +1146,106 @@ class PackageInstaller(object):
       self.Compile()
 
     if config.install_packages:
-      self.Install()
+      self._InstallUnlessPresent()
+
+  @classmethod
+  def ProcessAll(cls, installers, download=True):
+    """Runs the standard workflow for independent packages concurrently.
+
+    Each phase is run for all the packages in parallel before moving on to
+    the next phase. The packages are installed one at a time since they all
+    share the same install tree.
+
+    Args:
+      installers: (list[PackageInstaller]) Packages that do not depend on
+                  one another.
+      download: (bool) False if the packages were already downloaded.
+    """
+    if not installers:
+      return
+    config = installers[0]._config
+
+    def _Build(installer):
+      installer.Configure()
+      if config.build_packages:
+        installer.Compile()
+
+    if config.download_packages and download:
+      _DownloadAll(installers)
+
+    if config.build_packages or config.install_packages:
+      _RunInParallel([installer.Unpackage for installer in installers],
+                     DOWNLOAD_THREADS)
+      # Every build already runs config.build_jobs jobs, so only run as many
+      # builds at once as keeps the total within the cpu count.
+      _RunInParallel([functools.partial(_Build, installer)
+                      for installer in installers],
+                     max(1, _CpuCount() // config.build_jobs))
+
+    if config.install_packages:
+      for installer in installers:
+        installer._InstallUnlessPresent()
 
   @classmethod
   def CopyAllFiles(cls, from_dir, to_dir):
     """Copies one directory tree into another.
 
+    Hidden files and directories are not copied.
+
     Args:
       from_dir: (string) The directory to copy from.
       to_dir: (string) The directory to copy to.
     """
-    for elem in glob.glob(os.path.join(from_dir, '*')):
-      tail = os.path.split(elem)[1]
-      if os.path.isdir(elem):
-        targetdir = os.path.join(to_dir, tail)
-        if not os.path.exists(targetdir):
-          os.makedirs(targetdir)
-        PackageInstaller.CopyAllFiles(elem, targetdir)
-      else:
-        targetfile = os.path.join(to_dir, tail)
-        shutil.copyfile(elem, targetfile)
-        shutil.copystat(elem, targetfile)
+    for dirpath, dirnames, filenames in os.walk(from_dir):
+      dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+      targetdir = os.path.join(to_dir, os.path.relpath(dirpath, from_dir))
+      _EnsureDirectory(targetdir)
+      for name in filenames:
+        if not name.startswith('.'):
+          shutil.copy2(os.path.join(dirpath, name), targetdir)
+
+  @classmethod
+  def _LinkOrCopy(cls, from_path, to_path):
+    """Hard links from_path as to_path, copying it if links are unsupported.
+
+    Args:
+      from_path: (string) The existing file.
+      to_path: (string) The path to create, replacing any existing file.
+    """
+    if os.path.exists(to_path):
+      os.unlink(to_path)
+    try:
+      os.link(from_path, to_path)
+    except (AttributeError, OSError):
+      # No os.link on Windows, or the paths are on different devices.
+      shutil.copyfile(from_path, to_path)
 
   @classmethod
-  def RunOrDie(cls, cmd, error_msg):
+  def RunOrDie(cls, argv, error_msg, cwd=None, env=None):
     """Runs system command. Dies if the command fails.
 
+    The command is run directly rather than through a shell.
+
     Args:
-      cmd: (string) Command to execute.
+      argv: (list[string]) Program to execute followed by its arguments.
       error_msg: (string) Optional additional error to print on failure.
+      cwd: (string) The directory to run the command in. Defaults to the
+           current working directory.
+      env: (dict) The environment to run the command with. Defaults to
+           the current environment.
     """
+    cwd = cwd or os.getcwd()
+    cmd = ' '.join(argv)
     try:
-      print '>>> Executing [%s] in %s' % (cmd, os.getcwd())
-      ok = os.system(cmd) == 0
+      print('>>> Executing [%s] in %s' % (cmd, cwd))
+      ok = subprocess.call(argv, cwd=cwd, env=env) == 0
     except OSError:
       ok = False
 
     if not ok:
-      print 'Failed command: [%s] in %s' % (cmd, os.getcwd())
+      print('Failed command: [%s] in %s' % (cmd, cwd))
       if error_msg:
-        print '   %s' % error_msg
+        print('   %s' % error_msg)
       sys.exit(1)
 
   @classmethod
@@ -602,11 +1259,11 @@ class PackageInstaller(object):
     Returns:
       The package name of the archive strips the .tar.gz or .zip extension.
     """
-    for suffix in ['.tar.gz', '.zip', '.tgz', '.tar.bz2']:
-      if archive.endswith(suffix):
-        return archive[0:len(archive) - len(suffix)]
+    match = cls._ARCHIVE_SUFFIX_RE.search(archive)
+    if match:
+      return archive[:match.start()]
 
-    print 'Unhandled archive=%s' % archive
+    print('Unhandled archive=%s' % archive)
     sys.exit(1)
 
   @classmethod
@@ -616,7 +1273,7 @@ class PackageInstaller(object):
     Args:
       cmake_program: (string) The cmake program to check for.
     """
-    if not cls._VerifyProgram(cmake_program, '--version'):
+    if not cls._VerifyProgram(cmake_program):
       print('Could not find "cmake" on your PATH. '
             'Try running this script again with the arguments '
             '"-di cmake".\n'
@@ -631,9 +1288,7 @@ class PackageInstaller(object):
       make_program: (string) The make program to check for.
     """
     install_instructions = ''
-    args = '--version'
     if os.name == 'nt':
-      args = '/C /HELP'
       install_instructions = (
           'If you are using Visual Studio, try running the vcvars.bat script '
           ' for the version of Visual Studio you wish to use. '
@@ -641,28 +1296,26 @@ class PackageInstaller(object):
           ' C:\\"Program Files (x86)"\\"Microsoft Visual Studio 11.0"'
           '\\VC\\bin\\x86_amd64\\vcvars64.bat')
 
-    if not cls._VerifyProgram(make_program, args):
+    if not cls._VerifyProgram(make_program):
       print('Make sure that "%s" is in your path. %s' % (
           make_program, install_instructions))
       exit(1)
 
   @classmethod
-  def _VerifyProgram(cls, prog, args):
+  def _VerifyProgram(cls, prog):
     """Verify the program exists on the path.
 
+    The result is remembered since every package checks the same programs.
+
     Args:
       prog: (string) The name of the program to check.
-      args: (string) args to give program when running it.
 
     Returns:
       True if program is on PATH, False otherwise.
     """
-    try:
-      test = '%s %s' % (prog, args)
-      subprocess.Popen(test, stdout=subprocess.PIPE, shell=True)
-    except OSError:
-      return False
-    return True
+    if prog not in cls._verified_progs:
+      cls._verified_progs[prog] = which(prog) is not None
+    return cls._verified_progs[prog]
 
 
 class MongoosePackageInstaller(PackageInstaller):
@@ -685,7 +1338,7 @@ class MongoosePackageInstaller(PackageInstaller):
 
     # Mongoose just builds a server, and does so nonstandard.
     # We want a library. There's only one file so pretty simple.
-    print '>>> Creating CMakeLists.txt as %s' % cmakelists_path
+    print('>>> Creating CMakeLists.txt as %s' % cmakelists_path)
     with open(cmakelists_path, 'w') as f:
       f.write('cmake_minimum_required (VERSION 2.6)\n')
       f.write('project (Mongoose)\n')
@@ -696,20 +1349,26 @@ class MongoosePackageInstaller(PackageInstaller):
     """Copies headers and libraries to install the package."""
     config = self._config
     include_dir = os.path.join(config.abs_install_dir, 'include', 'mongoose')
-    if not os.path.exists(include_dir):
-      os.makedirs(include_dir)
-    shutil.copy(os.path.join(self._package_path, 'mongoose.h'), include_dir)
+    _EnsureDirectory(include_dir)
+    shutil.copy2(os.path.join(self._package_path, 'mongoose.h'), include_dir)
 
     libdir = os.path.join(config.abs_install_dir, 'lib')
-    if not os.path.exists(libdir):
-      os.makedirs(libdir)
+    _EnsureDirectory(libdir)
 
     if config.port != WINDOWS_PLATFORM:
-      shutil.copy(os.path.join(self._package_path, 'libmongoose.a'), libdir)
+      shutil.copy2(os.path.join(self._package_path, 'libmongoose.a'), libdir)
     else:
       for ext in ['lib', 'pdb']:
-        shutil.copy(os.path.join(self._package_path, 'mongoose.%s' % ext),
-                    libdir)
+        shutil.copy2(os.path.join(self._package_path, 'mongoose.%s' % ext),
+                     libdir)
+
+  def _InstalledArtifacts(self):
+    if self._config.port != WINDOWS_PLATFORM:
+      lib = 'libmongoose.a'
+    else:
+      lib = 'mongoose.lib'
+    return [os.path.join('lib', lib),
+            os.path.join('include', 'mongoose', 'mongoose.h')]
 
 
 class JsonCppPackageInstaller(PackageInstaller):
@@ -723,21 +1382,22 @@ class JsonCppPackageInstaller(PackageInstaller):
   def MaybeTweakAfterUnpackage(self):
     """Creates a CMakeLists.txt to build the package."""
     config = self._config
-    os.chdir(self._package_path)
-    if config.force and os.path.exists('CMakeLists.txt'):
-      os.unlink('CMakeLists.txt')
-    if os.path.exists('CMakeLists.txt'):
+    cmakelists_path = os.path.join(self._package_path, 'CMakeLists.txt')
+    if config.force and os.path.exists(cmakelists_path):
+      os.unlink(cmakelists_path)
+    if os.path.exists(cmakelists_path):
       return
 
-    if config.build_packages:
-      allfiles = ''
-
-    src_path = os.path.join('src', 'lib_json')
-    for elem in glob.glob('%s/*.cpp' % src_path):
-      allfiles = '%s "%s"' % (allfiles, elem)
+    # The sources are listed relative to the CMakeLists.txt file.
+    src_path = 'src/lib_json'
+    srcs = ['"%s/%s"' % (src_path, name)
+            for name in sorted(os.listdir(
+                os.path.join(self._package_path, 'src', 'lib_json')))
+            if name.endswith('.cpp')]
+    allfiles = ' '.join(srcs)
 
-    print '>>>  Creating CMakeLists.txt'
-    with open('CMakeLists.txt', 'w') as f:
+    print('>>>  Creating CMakeLists.txt as %s' % cmakelists_path)
+    with open(cmakelists_path, 'w') as f:
       f.write('cmake_minimum_required (VERSION 2.6)\n')
       f.write('project (JsonCpp)\n')
       f.write('INCLUDE_DIRECTORIES(./include src/lib_json)\n')
@@ -746,19 +1406,27 @@ class JsonCppPackageInstaller(PackageInstaller):
   def Install(self):
     """Copies the libraries nad header files to install the package."""
     config = self._config
-    print '>>>  Installing %s' % self._package_name
+    print('>>>  Installing %s' % self._package_name)
     PackageInstaller.CopyAllFiles(
         os.path.join(self._package_path, 'include'),
         os.path.join(config.abs_install_dir, 'include'))
     libdir = os.path.join(config.abs_install_dir, 'lib')
-    if not os.path.exists(libdir):
-      os.makedirs(libdir)
+    _EnsureDirectory(libdir)
 
     if config.port != WINDOWS_PLATFORM:
-      shutil.copy('libjsoncpp.a', libdir)
+      shutil.copy2(os.path.join(self._package_path, 'libjsoncpp.a'), libdir)
     else:
       for ext in ['lib', 'pdb']:
-        shutil.copy('jsoncpp.%s' % ext, libdir)
+        shutil.copy2(os.path.join(self._package_path, 'jsoncpp.%s' % ext),
+                     libdir)
+
+  def _InstalledArtifacts(self):
+    if self._config.port != WINDOWS_PLATFORM:
+      lib = 'libjsoncpp.a'
+    else:
+      lib = 'jsoncpp.lib'
+    return [os.path.join('lib', lib),
+            os.path.join('include', 'json', 'json.h')]
 
 
 class CMakeExeInstaller(PackageInstaller):
@@ -781,17 +1449,18 @@ class CMakeExeInstaller(PackageInstaller):
     """Runs installer to install CMake (on the system)."""
     config = self._config
     if not config.force:
-      if PackageInstaller._VerifyProgram('cmake', '--version'):
-        print 'Already have CMake'
+      if PackageInstaller._VerifyProgram('cmake'):
+        print('Already have CMake')
         return
 
-    print 'Installing CMake'
+    print('Installing CMake')
     download_dir = config.download_dir
     exe_filename = self._archive_file
-    os.chdir(download_dir)
     # This is a self-installing .exe file
     PackageInstaller.RunOrDie(
-        exe_filename, 'Failed to install CMake from %s.' % exe_filename)
+        [os.path.join(download_dir, exe_filename)],
+        'Failed to install CMake from %s.' % exe_filename,
+        cwd=download_dir)
 
 
 class IgnorePackageInstaller(PackageInstaller):
@@ -835,12 +1504,17 @@ class OpenSslPackageInstaller(PackageInstaller):
     # TODO(user): 20130626
     # These artifacts are probably not even needed. Investigate for a
     # future release.
-    print 'NOTE for Google APIs Client Library for C++ Installer:'
-    print '  If this fails it might be because we guessed the wrong platform.'
-    print '  Edit prepare_dependencies.py and notify us.'
-    print '  See the README in the release for contact information.'
+    print('NOTE for Google APIs Client Library for C++ Installer:')
+    print('  If this fails it might be because we guessed the wrong platform.')
+    print('  Edit prepare_dependencies.py and notify us.')
+    print('  See the README in the release for contact information.')
     super(OpenSslPackageInstaller, self).Configure()
 
+  def _InstalledArtifacts(self):
+    return [os.path.join('lib', 'libssl.a'),
+            os.path.join('lib', 'libcrypto.a'),
+            os.path.join('include', 'openssl', 'ssl.h')]
+
 
 class GFlagsPackageInstaller(PackageInstaller):
   """Custom installer for the GFlags package."""
@@ -864,24 +1538,33 @@ class GFlagsPackageInstaller(PackageInstaller):
     if config.compiler != VS_COMPILER:
       super(GFlagsPackageInstaller, self).Install()
       return
-    print '>>>  Installing %s' % self._package_name
+    print('>>>  Installing %s' % self._package_name)
     install_libdir = os.path.join(config.abs_install_dir, 'lib')
     install_includedir = os.path.join(config.abs_install_dir,
                                       'include', 'gflags')
-    if not os.path.exists(install_libdir):
-      os.makedirs(install_libdir)
-    if not os.path.exists(install_includedir):
-      os.makedirs(install_includedir)
+    _EnsureDirectory(install_libdir)
+    _EnsureDirectory(install_includedir)
     PackageInstaller.CopyAllFiles(
         os.path.join(self._package_path, 'src', 'windows', 'gflags'),
         install_includedir)
     release_dir = os.path.join(self._package_path,
                                'vsprojects', 'libgflags', 'Release')
+    copies = []
     for ext in ['lib', 'dll', 'pdb']:
-      print 'renaming %s.%s' % (os.path.join(release_dir, 'libgflags'), ext)
-      shutil.copyfile(
+      print('renaming %s.%s' % (os.path.join(release_dir, 'libgflags'), ext))
+      copies.append(functools.partial(
+          shutil.copyfile,
           '%s.%s' % (os.path.join(release_dir, 'libgflags'), ext),
-          '%s.%s' % (os.path.join(install_libdir, 'libgflags'), ext))
+          '%s.%s' % (os.path.join(install_libdir, 'libgflags'), ext)))
+    _RunInParallel(copies, len(copies))
+
+  def _InstalledArtifacts(self):
+    if self._config.compiler != VS_COMPILER:
+      lib = 'libgflags.a'
+    else:
+      lib = 'libgflags.lib'
+    return [os.path.join('lib', lib),
+            os.path.join('include', 'gflags', 'gflags.h')]
 
 
 class GMockPackageInstaller(PackageInstaller):
@@ -935,6 +1618,12 @@ class GMockPackageInstaller(PackageInstaller):
 class GLogPackageInstaller(PackageInstaller):
   """Custom installer for the GLog package."""
 
+  # Both spellings of the preprocessor test for windows or cygwin.
+  _WINDOWS_OR_CYGWIN_RE = re.compile(
+      r'defined(?:\(OS_WINDOWS\) \|\| defined\(OS_CYGWIN\)'
+      r'| OS_WINDOWS \|\| defined OS_CYGWIN)')
+  _LOG_STREAM_BUF_RE = re.compile(r'class LogStreamBuf')
+
   def __init__(self, config, url, package_name=None):
     """Standard PackageInstaller initializer.
 
@@ -959,35 +1648,18 @@ class GLogPackageInstaller(PackageInstaller):
         os.path.join(self._package_path, 'src', 'utilities.cc')
     ]
     for change_path in remove_cygwin_paths:
-      changed = False
-      with open(change_path, 'r') as f:
-        old_text = f.read()
-        # The source couple windows and cygwin together for some reason,
-        # but that doesnt compile. CYGWIN appears to work if you take these
-        # out (it will use pthreads instead of the windows API).
-        text = old_text.replace('defined(OS_WINDOWS) || defined(OS_CYGWIN)',
-                                'defined(OS_WINDOWS)')
-        text = text.replace('defined OS_WINDOWS || defined OS_CYGWIN',
-                            'defined(OS_WINDOWS)')
-        changed = old_text != text
-      if changed:
-        with open(change_path, 'w') as f:
-          f.write(text)
-        print 'Hacked %s' % change_path
+      # The source couple windows and cygwin together for some reason,
+      # but that doesnt compile. CYGWIN appears to work if you take these
+      # out (it will use pthreads instead of the windows API).
+      if _SubstituteInFile(change_path, self._WINDOWS_OR_CYGWIN_RE,
+                           'defined(OS_WINDOWS)'):
+        print('Hacked %s' % change_path)
 
     logging_h_path = os.path.join(
         self._package_path, 'src', 'windows', 'glog', 'logging.h')
-    changed = False
-    with open(logging_h_path, 'r') as f:
-      old_text = f.read()
-      text = old_text.replace('class LogStreamBuf',
-                              'class GOOGLE_GLOG_DLL_DECL LogStreamBuf')
-      changed = old_text != text
-
-    if changed:
-      with open(logging_h_path, 'w') as f:
-        f.write(text)
-      print 'Hacked %s' % logging_h_path
+    if _SubstituteInFile(logging_h_path, self._LOG_STREAM_BUF_RE,
+                         'class GOOGLE_GLOG_DLL_DECL LogStreamBuf'):
+      print('Hacked %s' % logging_h_path)
 
   def Install(self):
     """Overrides install to copy the generated headers and libs."""
@@ -999,19 +1671,29 @@ class GLogPackageInstaller(PackageInstaller):
     install_libdir = os.path.join(config.abs_install_dir, 'lib')
     install_includedir = os.path.join(
         config.abs_install_dir, 'include', 'glog')
-    print '>>>  Installing %s' % self._package_name
-    if not os.path.exists(install_libdir):
-      os.makedirs(install_libdir)
-    if not os.path.exists(install_includedir):
-      os.makedirs(install_includedir)
+    print('>>>  Installing %s' % self._package_name)
+    _EnsureDirectory(install_libdir)
+    _EnsureDirectory(install_includedir)
     PackageInstaller.CopyAllFiles(
         os.path.join(self._package_path, 'src', 'windows', 'glog'),
         install_includedir)
     release_dir = os.path.join(
         self._package_path, 'vsprojects', 'libglog', 'Release')
+    copies = []
     for ext in ['lib', 'dll', 'pdb']:
-      shutil.copyfile('%s.%s' % (os.path.join(release_dir, 'libglog'), ext),
-                      '%s.%s' % (os.path.join(install_libdir, 'libglog'), ext))
+      copies.append(functools.partial(
+          shutil.copyfile,
+          '%s.%s' % (os.path.join(release_dir, 'libglog'), ext),
+          '%s.%s' % (os.path.join(install_libdir, 'libglog'), ext)))
+    _RunInParallel(copies, len(copies))
+
+  def _InstalledArtifacts(self):
+    if self._config.port != WINDOWS_PLATFORM:
+      lib = 'libglog.a'
+    else:
+      lib = 'libglog.lib'
+    return [os.path.join('lib', lib),
+            os.path.join('include', 'glog', 'logging.h')]
 
 
 class CurlPackageInstaller(PackageInstaller):
@@ -1024,10 +1706,20 @@ class CurlPackageInstaller(PackageInstaller):
     super(CurlPackageInstaller, self).__init__(
         config, url, config_type=config_type)
 
+  def _InstalledArtifacts(self):
+    if self._config.compiler == VS_COMPILER:
+      # The CMake build names its libraries differently across versions.
+      return []
+    return [os.path.join('lib', 'libcurl.a'),
+            os.path.join('include', 'curl', 'curl.h')]
+
 
 class Installer(object):
   """Acquires, builds, and installs dependencies for the SDK."""
 
+  # Packages that others may depend on. These are processed first, in order.
+  _ORDERED_PACKAGES = ['cmake', 'openssl', 'glog']
+
   def __init__(self, config, restricted_package_names):
     """Set up variables from flags. Exit on failure.
 
@@ -1036,25 +1728,26 @@ class Installer(object):
       restricted_package_names: (Array) Subset of package names to install.
     """
 
-    print 'Initializing....'
+    print('Initializing....')
+    self._config = config
     # If non-empty then just prepare these packages.
     # The entries here are keys in url_map
     self._restricted_packages = restricted_package_names
 
-    self._url_map = {}
+    self._url_map = collections.OrderedDict()
     if config.port == WINDOWS_PLATFORM or config.port == CYGWIN_PLATFORM:
-      self._url_map.update({
+      self._url_map.update([
           # Use CMake as our build system for the libraries and some deps
-          'cmake': (CMakeExeInstaller(
+          ('cmake', CMakeExeInstaller(
               config,
               'http://www.cmake.org/files/v3.1/cmake-3.1.1-win32-x86.exe')),
 
-          'openssl': (IgnorePackageInstaller(config, 'ignoring_openssl')),
-      })
+          ('openssl', IgnorePackageInstaller(config, 'ignoring_openssl')),
+      ])
     else:
-      self._url_map.update({
+      self._url_map.update([
           # Use CMake as our build system for the libraries and some deps
-          'cmake': (PackageInstaller(
+          ('cmake', PackageInstaller(
               config,
               'http://www.cmake.org/files/v3.1/cmake-3.1.1.tar.gz',
               config_type=CONFIGURE_CONFIG)),
@@ -1063,34 +1756,34 @@ class Installer(object):
           # the OpenSslCodec library for the OpenSslCodec for data encryption.
           # The OpenSslCodec is not requird so if you get an https transport
           # from somewhere else then you do not need this dependency.
-          'openssl': (OpenSslPackageInstaller(
+          ('openssl', OpenSslPackageInstaller(
               config, 'https://www.openssl.org/source/openssl-1.1.0j.tar.gz')),
-          })
+          ])
 
-    self._url_map.update({
+    self._url_map.update([
         # GFlags is only used for some examples.
         # Only used for tests and samples.
-        'gflags': (GFlagsPackageInstaller(
+        ('gflags', GFlagsPackageInstaller(
           config,
           'https://github.com/gflags/gflags/archive/v2.2.0.tar.gz',
           'gflags-2.2.0')),
 
         # GLog is the logging mechanism used through the client API
-        'glog': (GLogPackageInstaller(
+        ('glog', GLogPackageInstaller(
           config,
           'https://github.com/google/glog/archive/v0.3.4.tar.gz',
           'glog-0.3.4')),
 
         # GMock (and included GTest) are only used for tests, not runtime
         # Only used for tests.
-        'gmock': (GMockPackageInstaller(
+        ('gmock', GMockPackageInstaller(
           config,
           'https://github.com/google/googlemock/archive/release-1.7.0.tar.gz',
           'googlemock-release-1.7.0')),
 
         # For now we use JsonCpp for JSON support in the Client Service Layer
         # and other places where we process JSON encoded data.
-        'jsoncpp': (JsonCppPackageInstaller(
+        ('jsoncpp', JsonCppPackageInstaller(
             config,
             'http://downloads.sourceforge.net/project/jsoncpp'
             '/jsoncpp/0.5.0/jsoncpp-src-0.5.0.tar.gz')),
@@ -1098,35 +1791,32 @@ class Installer(object):
         # Mongoose is used as webserver for samples.
         # The ownership and license style seems to keep changing, so we do not
         # download it by default.
-        # 'mongoose': (MongoosePackageInstaller(
+        # ('mongoose', MongoosePackageInstaller(
         #   config,
         #   'https://github.com/cesanta/mongoose/archive/6.7.zip',
         #   'mongoose-6.7')),
 
-        'curl': (CurlPackageInstaller(
+        ('curl', CurlPackageInstaller(
             config, 'https://github.com/curl/curl/releases/download/curl-7_54_0/curl-7.54.0.tar.gz')),
-        })
+        ])
 
     # make sure cmake occurs first since others may depend on it
     if not self._restricted_packages:
-      self._restricted_packages = self._url_map.keys()
-      ordered_packages = ['cmake', 'openssl', 'glog']
-      for p in ordered_packages:
-        self._restricted_packages.remove(p)
-      self._restricted_packages = ordered_packages + self._restricted_packages
+      self._restricted_packages = self._ORDERED_PACKAGES + [
+          name for name in self._url_map
+          if name not in self._ORDERED_PACKAGES]
 
-  def ProcessDependencyOrDie(self, name):
-    """Process a single dependency.
+  def GetInstallerOrDie(self, name):
+    """Returns the PackageInstaller for a single dependency.
 
     Args:
-      name: (string) The name of the dependency to process.
+      name: (string) The name of the dependency.
     """
-
     value = self._url_map.get(name)
     if not value:
-      print 'Unknown package "%s"' % name
+      print('Unknown package "%s"' % name)
       sys.exit(1)
-    value.Process()
+    return value
 
   def Run(self):
     """Run the installer.
@@ -1136,9 +1826,20 @@ class Installer(object):
     """
     restricts = self._restricted_packages
 
-    # Attempt to process each of the requested packages.
+    # Nothing depends on downloads finishing in order, so fetch everything
+    # at once before building anything.
+    if self._config.download_packages:
+      _DownloadAll([self.GetInstallerOrDie(key) for key in restricts])
+
+    # Packages that others depend on are processed one at a time first.
+    # The remaining ones are independent so can be processed together.
+    independent = []
     for key in restricts:
-      self.ProcessDependencyOrDie(key)
+      if key in self._ORDERED_PACKAGES:
+        self.GetInstallerOrDie(key).Process(download=False)
+      else:
+        independent.append(self.GetInstallerOrDie(key))
+    PackageInstaller.ProcessAll(independent, download=False)
     return restricts
 
 
@@ -1148,14 +1849,18 @@ if __name__ == '__main__':
   try:
     opts, restricted_packages = getopt.getopt(
         sys.argv[1:], 'bdi', ['download_dir=', 'install_dir=', 'force',
-                              'debug'])
+                              'debug', 'update_manifest'])
     config_info.SetOptions(opts)
   except getopt.GetoptError:
-    print ('%s: [-b] [-d] [-i]' % sys.argv[0]
-           + '[--download_dir=<path>] [--install_dir=<path>] [--force]')
+    print('%s: [-b] [-d] [-i]' % sys.argv[0]
+           + '[--download_dir=<path>] [--install_dir=<path>] [--force]'
+           + ' [--update_manifest]')
     sys.exit(1)
 
   installer = Installer(config_info, restricted_packages)
 
   processed_packages = installer.Run()
-  print '\nFinished processing %s' % str(processed_packages)
+  if config_info.update_manifest:
+    _SaveManifest(DEPS_MANIFEST_PATH, config_info.manifest)
+    print('Updated %s' % DEPS_MANIFEST_PATH)
+  print('\nFinished processing %s' % processed_packages)
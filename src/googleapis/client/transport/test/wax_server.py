@@ -23,23 +23,62 @@ Usage:
 
 from BaseHTTPServer import BaseHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
 
-import copy
+import collections
 import getopt
+import itertools
 import json
 import os
 import re
 import signal
-import string
 import sys
 import threading
 import time
 
 
-_RE_SESSION_COMMAND = re.compile('^/sessions/([^/]+)/items')
-_RE_ITEM_COMMAND = re.compile('^/sessions/([^/]+)/items/([^/]+)')
+# Matches both the items collection of a session and an individual item.
+# The item group is None for the collection.
+_RE_ITEMS_COMMAND = re.compile('^/sessions/([^/]+)/items(?:/([^/]+))?')
 _JSON_CONTENT_TYPE = 'application/json'
-_SERVER_SETTINGS = {'run': True}
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_WAX_DATA_ITEM_KIND = 'wax#waxDataItem'
+
+# Request payloads larger than this are rejected before being read.
+_MAX_PAYLOAD_SIZE = 1 << 20
+
+# Shared by all the JSON requests and responses, which are encoded compactly.
+_JSON_DECODER = json.JSONDecoder()
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+# The error responses are fixed so they are encoded once up front.
+_ERROR_RESPONSES = dict(
+    ((msg, http_code),
+     _JSON_ENCODER.encode({'message': msg, 'code': http_code}))
+    for msg, http_code in [('Invalid JSON', 400),
+                           ('JSON missing id', 400),
+                           ('Mismatched item ids', 400),
+                           ('Item already exists', 403),
+                           ('Invalid Content-Length', 400),
+                           ('Content-Length required', 411),
+                           ('Payload too large', 413),
+                           ('Unknown item', 404),
+                           ('Unknown item in session', 404),
+                           ('Unknown sessionId', 404),
+                           ('URL Not Available', 404),
+                           ('Unhandled method', 405)])
+
+
+class _PayloadError(Exception):
+  """Raised when a request payload is refused without being read.
+
+  Attributes:
+    http_code: (int) The HTTP status code to respond with.
+  """
+
+  def __init__(self, msg, http_code):
+    super(_PayloadError, self).__init__(msg)
+    self.http_code = http_code
 
 
 class SessionData(object):
@@ -51,21 +90,26 @@ class SessionData(object):
   However, this is a testing server that is not expected to be run for long
   periods of time.
 
-  A session contains a list of items where an item is a dictionary.
+  A session contains an ordered collection of items where an item is a
+  dictionary. Items are keyed by their 'id' and kept in the order they were
+  last added or modified.
   Items have a 'kind' attribute to make them compatible with the Wax Service.
+  Stored items are replaced rather than modified in place, so shallow copies
+  of them are enough to keep callers from seeing later changes.
   The session is initialized with two items, A and B, to be compatible with
   the Wax Service.
   """
 
   def __init__(self):
     """Constructs a new session instance."""
-    self._created = time.clock()
     self._mutex = threading.Lock()
-    self._items = []
+    self._items = collections.OrderedDict()
 
     # Add items A and B by default to mimick the service's behavior.
-    self._items.append(self.AddWaxKind({'id': 'A', 'name': 'Item A'}))
-    self._items.append(self.AddWaxKind({'id': 'B', 'name': 'Item B'}))
+    self._items['A'] = {'id': 'A', 'name': 'Item A',
+                        'kind': _WAX_DATA_ITEM_KIND}
+    self._items['B'] = {'id': 'B', 'name': 'Item B',
+                        'kind': _WAX_DATA_ITEM_KIND}
 
   def _FindItem(self, key):
     """Finds item with the given id, if present in the session.
@@ -78,11 +122,7 @@ class SessionData(object):
     Returns:
       A reference to the item or None if one is not present.
     """
-
-    for session_item in self._items:
-      if session_item['id'] == key:
-        return session_item
-    return None
+    return self._items.get(key)
 
   def AddNewItem(self, key, item):
     """Add an item to the session list if the specified identifier is unique.
@@ -96,13 +136,13 @@ class SessionData(object):
       The actual values for the added item (including added values).
       None indicates a failure (because the identifier already exists)
     """
-    wax = None
-    self._mutex.acquire()
-    if not self._FindItem(key):
-      wax = self.AddWaxKind(item)
-      self._items.append(copy.deepcopy(wax))
-    self._mutex.release()
-    return wax
+    item['kind'] = _WAX_DATA_ITEM_KIND
+    stored = dict(item)
+    with self._mutex:
+      if self._FindItem(key):
+        return None
+      self._items[key] = stored
+    return item
 
   def ReplaceItem(self, key, item):
     """Inserts the item into the session, or replaces the item for identifer.
@@ -114,15 +154,12 @@ class SessionData(object):
     Returns:
        A copy of the inserted item.
     """
-    wax = self.AddWaxKind(item)
-    self._mutex.acquire()
-    session_item = self._FindItem(key)
-    if session_item:
-      self._items.remove(session_item)
-
-    self._items.append(copy.deepcopy(wax))
-    self._mutex.release()
-    return wax
+    item['kind'] = _WAX_DATA_ITEM_KIND
+    stored = dict(item)
+    with self._mutex:
+      self._items.pop(key, None)
+      self._items[key] = stored
+    return item
 
   def PatchItem(self, key, item):
     """Updates an existing item with the given id with the elements of item.
@@ -137,16 +174,14 @@ class SessionData(object):
     Returns:
       A copy of the patched item or None on falure.
     """
-    wax = None
-    self._mutex.acquire()
-    session_item = self._FindItem(key)
-    if session_item:
-      self._items.remove(session_item)
-      wax = dict(session_item.items() + item.items())
-      self._items.append(copy.deepcopy(wax))
-
-    self._mutex.release()
-    return wax
+    with self._mutex:
+      session_item = self._items.pop(key, None)
+      if not session_item:
+        return None
+      patched = dict(session_item)
+      patched.update(item)
+      self._items[key] = patched
+    return dict(patched)
 
   def DeleteItem(self, key):
     """Deletes an item from the session.
@@ -157,12 +192,8 @@ class SessionData(object):
     Returns:
       The deleted item or None.
     """
-    self._mutex.acquire()
-    session_item = self._FindItem(key)
-    if session_item:
-      self._items.remove(session_item)
-    self._mutex.release()
-    return session_item
+    with self._mutex:
+      return self._items.pop(key, None)
 
   def GetItemCopy(self, key):
     """Get a copy of the item with the given identifier.
@@ -175,13 +206,12 @@ class SessionData(object):
     Returns:
       None if the identifier isnt present. Otherwise a copy of the item.
     """
-    result = None
-    self._mutex.acquire()
-    session_item = self._FindItem(key)
+    with self._mutex:
+      session_item = self._FindItem(key)
+    # Stored items are never modified so they can be copied without the lock.
     if session_item:
-      result = copy.deepcopy(session_item)
-    self._mutex.release()
-    return result
+      return dict(session_item)
+    return None
 
   def GetAllItemsCopy(self):
     """Returns a copy of the list of all items.
@@ -189,22 +219,9 @@ class SessionData(object):
     Returns:
       A copy is returned for simple thread-safety.
     """
-    self._mutex.acquire()
-    result = copy.deepcopy(self._items)
-    self._mutex.release()
-    return result
-
-  def AddWaxKind(self, item):
-    """Helper function that adds the 'kind' attribute to an item.
-
-    Args:
-      item: (dict)  The item to modify.
-
-    Returns:
-      A reference to the item with a 'kind' attribute added.
-    """
-    item['kind'] = 'wax#waxDataItem'
-    return item
+    with self._mutex:
+      session_items = self._items.values()
+    return [dict(item) for item in session_items]
 
 
 class Repository(object):
@@ -216,8 +233,10 @@ class Repository(object):
   def __init__(self):
     """Initializes an empty repository."""
     self._sessions = {}
-    self._nodeid = str(time.clock())
-    self._sequence_num = 0
+    # Distinguishes identifiers from those of other server instances.
+    self._nodeid = '%d-%d' % (os.getpid(), int(time.time() * 1e6))
+    # Taking the next number from a count is atomic, so needs no lock.
+    self._sequence_nums = itertools.count(1)
     self._mutex = threading.Lock()
 
   def GetSessionData(self, key):
@@ -229,10 +248,8 @@ class Repository(object):
     Returns:
       A reference to the SessionData or None.
     """
-    self._mutex.acquire()
-    session_data = self._sessions.get(key)
-    self._mutex.release()
-    return session_data
+    with self._mutex:
+      return self._sessions.get(key)
 
   def RemoveIdentifier(self, key):
     """Removes a session identifier and its data.
@@ -243,11 +260,8 @@ class Repository(object):
     Returns:
       The session data removed or None
     """
-    self._mutex.acquire()
-    session_data = self._sessions.pop(key, None)
-    self._mutex.release()
-
-    return session_data
+    with self._mutex:
+      return self._sessions.pop(key, None)
 
   def NewIdentifier(self, basename):
     """Adds a new empty session and gives it a new unique identifier.
@@ -257,11 +271,10 @@ class Repository(object):
     Returns:
        The generated identifier to refer to the SessionData in the future.
     """
-    self._mutex.acquire()
-    self._sequence_num += 1
-    key = '%s-%s-%s' % (basename, self._nodeid, self._sequence_num)
-    self._sessions[key] = SessionData()
-    self._mutex.release()
+    key = '%s-%s-%s' % (basename, self._nodeid, next(self._sequence_nums))
+    session_data = SessionData()
+    with self._mutex:
+      self._sessions[key] = session_data
     return key
 
 
@@ -269,7 +282,21 @@ REPOSITORY_ = Repository()
 
 
 class WaxHandler(BaseHTTPRequestHandler):
-  """Implements a Wax Service interface for the web server."""
+  """Implements a Wax Service interface for the web server.
+
+  Connections are kept open between requests, and responses are buffered
+  until the request has been handled.
+  """
+
+  protocol_version = 'HTTP/1.1'
+  wbufsize = -1
+
+  # Maps (method, path) of the commands that are not on a session to the
+  # name of the method processing them.
+  _SESSIONLESS_COMMANDS = {
+      ('POST', '/newsession'): '_ProcessNewSessionCommand',
+      ('POST', '/removesession'): '_ProcessRemoveSessionCommand',
+  }
 
   def _SendResponse(self, payload, http_code, content_type='text/plain'):
     """Send HTTP response.
@@ -282,10 +309,24 @@ class WaxHandler(BaseHTTPRequestHandler):
     Returns:
       The http_code.
     """
-    self.send_response(http_code)
-    self.send_header('Content-Type', content_type)
-    self.end_headers()
-    self.wfile.write(payload)
+    # The status line, headers and body go out in a single write rather
+    # than the one per line that send_response and send_header would do.
+    self.log_request(http_code)
+    response = [
+        '%s %d %s\r\n' % (self.protocol_version, http_code,
+                          self.responses.get(http_code, ('',))[0]),
+        'Server: %s\r\n' % self.version_string(),
+        'Date: %s\r\n' % self.date_time_string(),
+        'Content-Type: %s\r\n' % content_type]
+    if http_code != 204:
+      response.append('Content-Length: %d\r\n' % len(payload))
+    if self._unread_payload:
+      # The next request cannot be found without reading past this one's.
+      self.close_connection = 1
+    if self.close_connection:
+      response.append('Connection: close\r\n')
+    response.extend(['\r\n', payload])
+    self.wfile.write(''.join(response))
     return http_code
 
   def _SendJsonObjectResponse(self, obj, http_code):
@@ -299,7 +340,7 @@ class WaxHandler(BaseHTTPRequestHandler):
       The http_code.
     """
     return self._SendResponse(
-        json.dumps(obj), http_code, content_type=_JSON_CONTENT_TYPE)
+        _JSON_ENCODER.encode(obj), http_code, content_type=_JSON_CONTENT_TYPE)
 
   def _SendJsonErrorResponse(self, msg, http_code):
     """Sends a JSON a JSON-encoded HTTP response containing the message.
@@ -311,10 +352,11 @@ class WaxHandler(BaseHTTPRequestHandler):
     Returns:
       The http_code.
     """
+    payload = _ERROR_RESPONSES.get((msg, http_code))
+    if payload is None:
+      payload = _JSON_ENCODER.encode({'message': msg, 'code': http_code})
     return self._SendResponse(
-        json.dumps({'message': msg, 'code': http_code}),
-        http_code,
-        content_type=_JSON_CONTENT_TYPE)
+        payload, http_code, content_type=_JSON_CONTENT_TYPE)
 
   def _ProcessNewSessionCommand(self):
     """Adds a new session and sends a response.
@@ -433,6 +475,9 @@ class WaxHandler(BaseHTTPRequestHandler):
     Returns:
       The final HTTP status code.
     """
+    if request_json.get('id', item_id) != item_id:
+      return self._SendJsonErrorResponse('Mismatched item ids', 400)
+
     patched_item = session_data.PatchItem(item_id, request_json)
     if patched_item:
       return self._SendJsonObjectResponse(patched_item, 200)
@@ -462,45 +507,80 @@ class WaxHandler(BaseHTTPRequestHandler):
 
     Raises:
       ValueError: if the payload was not properly chunk encoded.
+      _PayloadError: if the payload is larger than _MAX_PAYLOAD_SIZE.
 
     Returns:
       The decoded payload string.
     """
-    payload = []
+    # The chunks are appended in place rather than collected and joined.
+    payload = bytearray()
     while True:
-      chunk_len = 0
-      while True:
-        hex_digit = self.rfile.read(1)
-        if hex_digit in string.hexdigits:
-          chunk_len = 16 * chunk_len + int(hex_digit, 16)
-        elif hex_digit != '\r' or self.rfile.read(1) != '\n':
-          raise ValueError('Expected \\r\\n termination')
-        else:
-          break
-
+      # The size line is hex digits, optionally followed by ;extensions.
+      size_line = self.rfile.readline()
+      if not size_line.endswith('\r\n'):
+        raise ValueError('Expected \\r\\n termination')
+      chunk_size = size_line.split(';', 1)[0].strip()
+      # int() would also take a sign or 0x prefix, and a negative size would
+      # read to the end of the stream.
+      if not chunk_size or not _HEX_DIGITS.issuperset(chunk_size):
+        raise ValueError('Invalid chunk size %r' % chunk_size)
+      chunk_len = int(chunk_size, 16)
       if chunk_len == 0:
         break
-      payload.append(self.rfile.read(chunk_len))
+      if len(payload) + chunk_len > _MAX_PAYLOAD_SIZE:
+        raise _PayloadError('Payload too large', 413)
+      payload.extend(self.rfile.read(chunk_len))
+      if self.rfile.readline() != '\r\n':
+        raise ValueError('Expected \\r\\n after chunk data')
+
+    # Skip any trailer headers up to the blank line ending the payload.
+    while self.rfile.readline() not in ('\r\n', ''):
+      pass
+
+    return str(payload)
 
-    return ''.join(payload)
+  def _GetContentLength(self):
+    """Returns the request's Content-Length, or None if it does not have one.
+
+    Raises:
+      _PayloadError: if the length is invalid or larger than
+                     _MAX_PAYLOAD_SIZE.
+    """
+    content_length = self.headers.get('Content-Length')
+    if content_length is None:
+      return None
+    content_length = content_length.strip()
+    if not content_length.isdigit():
+      raise _PayloadError('Invalid Content-Length', 400)
+    length = int(content_length)
+    if length > _MAX_PAYLOAD_SIZE:
+      raise _PayloadError('Payload too large', 413)
+    return length
 
   def _GetJson(self):
     """Reads JSON object from payload.
 
+    Raises:
+      _PayloadError: if the payload is refused.
+
     Returns:
       JSON decoded object
     """
-    encoding = self.headers.getheader('Transfer-Encoding')
+    headers = self.headers
+    encoding = headers.get('Transfer-Encoding')
+    content_type = headers.get('Content-Type')
     if encoding == 'chunked':
       payload = self._ReadChunkedPayload()
+      self._unread_payload = False
     else:
-      length = int(self.headers.getheader('Content-Length'))
-      payload = self.rfile.read(length)
-      if (not payload
-          or self.headers.getheader('Content-Type') != _JSON_CONTENT_TYPE):
+      if self._content_length is None:
+        raise _PayloadError('Content-Length required', 411)
+      payload = self.rfile.read(self._content_length)
+      self._unread_payload = False
+      if not payload or content_type != _JSON_CONTENT_TYPE:
         return None
 
-    json_item = json.loads(payload)
+    json_item = _JSON_DECODER.decode(payload)
     if not json_item:
       return None
 
@@ -515,27 +595,51 @@ class WaxHandler(BaseHTTPRequestHandler):
     Returns:
       The response HTTP status code sent.
     """
-    if self.path == '/quit':
-      _SERVER_SETTINGS['run'] = False
-      return self._SendResponse('BYE', 200)
+    # Cleared once the payload is read. Until then the connection cannot be
+    # reused for another request.
+    self._unread_payload = True
+    try:
+      self._content_length = self._GetContentLength()
+      self._unread_payload = bool(self.headers.get('Transfer-Encoding')
+                                  or self._content_length)
+      return self._DispatchCommand(method)
+    except _PayloadError as e:
+      return self._SendJsonErrorResponse(str(e), e.http_code)
+
+  def _DispatchCommand(self, method):
+    """Executes the WAX method for the request path and sends the response.
 
-    if self.path == '/newsession' and method == 'POST':
-      return self._ProcessNewSessionCommand()
-
-    if self.path == '/removesession' and method == 'POST':
-      return self._ProcessRemoveSessionCommand()
+    Args:
+      method: (string) The HTTP method type received.
 
-    match = _RE_ITEM_COMMAND.match(self.path)
-    if match:
-      self._HandleItemMethod(method, match.group(1), match.group(2))
-      return
+    Raises:
+      _PayloadError: if the request payload is refused.
 
-    match = _RE_SESSION_COMMAND.match(self.path)
+    Returns:
+      The response HTTP status code sent.
+    """
+    if self.path == '/quit':
+      self.close_connection = 1
+      http_code = self._SendResponse('BYE', 200)
+      self.wfile.flush()
+      # main() waits for this request to finish once serve_forever stops,
+      # rather than exiting while this thread is still closing the connection.
+      self.server.quit_thread = threading.current_thread()
+      threading.Thread(target=self.server.shutdown).start()
+      return http_code
+
+    command = self._SESSIONLESS_COMMANDS.get((method, self.path))
+    if command:
+      return getattr(self, command)()
+
+    match = _RE_ITEMS_COMMAND.match(self.path)
     if match:
-      self._HandleSessionMethod(method, match.group(1))
-      return
+      session_id, item_id = match.groups()
+      if item_id:
+        return self._HandleItemMethod(method, session_id, item_id)
+      return self._HandleSessionMethod(method, session_id)
 
-    self._SendJsonErrorResponse('URL Not Available', 404)
+    return self._SendJsonErrorResponse('URL Not Available', 404)
 
   def _HandleSessionMethod(self, method, session_id):
     """Executes method on wax sessions resource and sends response.
@@ -549,8 +653,7 @@ class WaxHandler(BaseHTTPRequestHandler):
     """
     session_data = REPOSITORY_.GetSessionData(session_id)
     if not session_data:
-      self._SendJsonErrorResponse('Unknown sessionId', 404)
-      return
+      return self._SendJsonErrorResponse('Unknown sessionId', 404)
 
     if method == 'GET':
       return self._ProcessGetSessionItemsCommand(session_data)
@@ -611,6 +714,19 @@ class WaxHandler(BaseHTTPRequestHandler):
     self._DispatchMethod('PUT')
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  """An HTTPServer that handles each request on its own thread.
+
+  Requests from different sessions do not wait on one another, including
+  the delay added to inserts for testing timeouts.
+  """
+
+  daemon_threads = True
+
+  # The thread handling the /quit request, once there has been one.
+  quit_thread = None
+
+
 def main(argv):
   """Runs the program."""
   try:
@@ -634,14 +750,17 @@ def main(argv):
   if host != '0.0.0.0':
     print 'Only available on localhost (-g not provided)'
 
-  server = HTTPServer((host, port), WaxHandler)
+  server = ThreadingHTTPServer((host, port), WaxHandler)
   print 'Started WaxServer on %s:%s' % (host, port)
   if signal_pid != 0:
     print 'Server ready -- signaling %d' % signal_pid
     os.kill(signal_pid, signal.SIGUSR1)
 
-  while _SERVER_SETTINGS['run']:
-    server.handle_request()
+  # Runs until a /quit request shuts the server down.
+  server.serve_forever()
+  server.server_close()
+  if server.quit_thread:
+    server.quit_thread.join()
 
 
 if __name__ == '__main__':